@@ -0,0 +1,6 @@
+# Network settings, edited before the board is flashed. Whether the board
+# hosts its own access point or joins a network, and whether the OLED is
+# used, are chosen by the constants at the top of main.py. The credentials
+# of the network to join are stored in NVS by provision.py.
+
+AP_ESSID = 'OpenMUD_4000'
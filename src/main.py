@@ -1,34 +1,156 @@
+import esp32
+import machine
 import network
+import asyncio
+import time
+import gc
+import sys
 
-if 1:
+from micropython import const
+from config import AP_ESSID
+import mudserver
 
-    wlan = network.WLAN(network.AP_IF)
-    wlan.active(True)
-    wlan.config(essid='OpenMUD_4000')
-                 
-if 0:
-    network.WLAN(network.AP_IF).active(False)
-    wlan = network.WLAN(network.STA_IF)
-    #wlan.config(pm=wlan.PM_NONE)
-    wlan.active(True)
+# run the core at full speed: the ESP32-C3 tops out at 160 MHz
+machine.freq(160000000)
 
-    wlan.config(txpower=18)
+# 1 hosts an open access point for players to join, 0 joins an existing
+# network with the credentials stored by provision.py
+_AP_MODE = const(1)
+# show the MUD's address on an SSD1306 OLED wired to pins 8/9
+_OLED = const(0)
+# both are compile-time constants so the branch that is not selected is
+# dropped from the bytecode entirely
 
-    wlan.connect('XXX', 'XXX')
+# give up on an association attempt after this long, then back off
+CONNECT_TIMEOUT_MS = 15000
+MAX_BACKOFF_MS = 30000
 
-    while not wlan.isconnected():
-        pass
 
-    print('Network config:', wlan.ifconfig())
+async def connect_wifi(wlan, ssid, password):
+    attempt = 0
+    while True:
+        wlan.connect(ssid, password)
+        deadline = time.ticks_add(time.ticks_ms(), CONNECT_TIMEOUT_MS)
+        # sleep between polls rather than spinning, so the scheduler (and the
+        # RTOS servicing the WiFi driver) gets to run while we associate
+        while not wlan.isconnected() and time.ticks_diff(deadline, time.ticks_ms()) > 0:
+            await asyncio.sleep_ms(200)
+        if wlan.isconnected():
+            return
 
-    import machine
-    i2c = machine.I2C(sda=machine.Pin(8), scl=machine.Pin(9))
+        # bad credentials or AP outage: reset the interface and retry later
+        print('WiFi connect timed out, retrying')
+        wlan.disconnect()
+        wlan.active(False)
+        await asyncio.sleep_ms(500)
+        wlan.active(True)
+        await asyncio.sleep_ms(min(MAX_BACKOFF_MS, 500 * 2 ** attempt))
+        attempt += 1
+
+
+def nvs_get(nvs, key):
+    # the bytes stored under key, or None if it has never been written
+    buf = bytearray(64)
+    try:
+        n = nvs.get_blob(key, buf)
+    except OSError:
+        return None
+    return bytes(buf[:n])
+
+
+async def oled_init():
+    # the OLED driver is only needed here, so import it lazily and bring the
+    # display up while the WiFi association is still in progress
     from ssd1306 import SSD1306_I2C
+    # the OLED flush is bound by the I2C clock; run the bus at the
+    # ESP32-C3 controller's 800 kHz ceiling instead of the default
+    i2c = machine.I2C(0, sda=machine.Pin(8), scl=machine.Pin(9), freq=800000)
     oled = SSD1306_I2C(128, 32, i2c)
     oled.poweron()
+    return oled
+
+
+async def main():
+    # bind the MUD port straight away: lwIP accepts on it as soon as the
+    # interface gets an address, so DHCP overlaps the rest of the bring-up
+    listen_socket = mudserver.listen(4000)
+
+    if _OLED:
+        oled_task = asyncio.create_task(oled_init())
+
+    if _AP_MODE:
+        network.hostname('mud')
+        wlan = network.WLAN(network.AP_IF)
+        wlan.active(True)
+        # the MUD is meant for a couple of players at a time: cap the
+        # association table and keep the network open on a fixed channel
+        wlan.config(essid=AP_ESSID, channel=6, max_clients=2,
+                    authmode=network.AUTH_OPEN)
+    else:
+        network.WLAN(network.AP_IF).active(False)
+        wlan = network.WLAN(network.STA_IF)
+        wlan.active(True)
+        # keep the receiver on: power-save buffers inbound frames until the
+        # next DTIM beacon, adding 100+ ms to every keystroke
+        wlan.config(pm=wlan.PM_NONE)
+
+        # on warm reboots (watchdog, soft reset, deep sleep) reuse the address
+        # from the last DHCP lease as a static config and skip the DHCP round
+        # trip; a cold boot always asks DHCP again and refreshes the cache
+        nvs = esp32.NVS('net')
+        lease = None
+        if machine.reset_cause() in (machine.SOFT_RESET, machine.WDT_RESET,
+                                     machine.DEEPSLEEP_RESET):
+            lease = nvs_get(nvs, 'lease')
+        if lease:
+            try:
+                wlan.ifconfig(tuple(lease.decode().split(',')))
+            except (ValueError, OSError):
+                # a malformed cache: ask DHCP and store a fresh lease
+                lease = None
+
+        # the credentials are written to NVS once by provision.py, so they
+        # are not interned as string literals and can be freed after connect
+        ssid = nvs_get(nvs, 'ssid')
+        psk = nvs_get(nvs, 'psk')
+        if ssid is None:
+            raise RuntimeError('no WiFi credentials, run provision.py first')
+        await connect_wifi(wlan, ssid, psk or b'')
+        del ssid, psk
+
+        if not lease:
+            nvs.set_blob('lease', ','.join(wlan.ifconfig()))
+            nvs.commit()
+
+        # only drive the PA hard when the AP is actually far away; full power
+        # draws enough current to brown out marginal USB supplies
+        rssi = wlan.status('rssi')
+        wlan.config(txpower=8 if rssi > -55 else 14 if rssi > -70 else 18)
+
+    # ifconfig() builds a fresh tuple on every call: fetch the address once
+    ip = wlan.ifconfig()[0]
+    # one preformatted write to the UART
+    sys.stdout.write('Network config: %s\n' % ip)
+
+    # hand the short-lived bring-up allocations back before the MUD
+    # allocates its socket buffers, then collect proactively once another
+    # quarter of the free heap has been allocated rather than stalling for a
+    # full sweep when the heap runs out mid-game
+    gc.collect()
+    gc.threshold(gc.mem_free() // 4 + gc.mem_alloc())
+
+    # run the game loop as a task so the listener is already accepting
+    # players while the OLED is being drawn
+    import simplemud
+    game = asyncio.create_task(simplemud.main(listen_socket))
+
+    if _OLED:
+        oled = await oled_task
+        oled.text('MUD on port 4000 :', 0, 0)
+        oled.text('@' + ip, 0, 15)
+        oled.show()
+
+    await game
 
-    oled.text('MUD on port 4000 :', 0, 0)
-    oled.text("@"+str(wlan.ifconfig()[0]), 0, 15)
-    oled.show()
 
-import simplemud
+asyncio.run(main())
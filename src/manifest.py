@@ -0,0 +1,12 @@
+# Frozen-module manifest for building a MUD-specific MicroPython image.
+# Modules listed here are compiled to bytecode and embedded in the firmware,
+# so they are not parsed from .py at every boot. Build with e.g.:
+#   make BOARD=LOLIN_C3_MINI FROZEN_MANIFEST=/path/to/esp32-mud/src/manifest.py
+
+include("$(PORT_DIR)/boards/manifest.py")
+
+module("simplemud.py", opt=3)
+module("mudserver.py", opt=3)
+module("utils.py", opt=3)
+module("rms.py", opt=3)
+module("ssd1306.py", opt=3)
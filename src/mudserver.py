@@ -13,13 +13,258 @@ import select
 import time
 import sys
 import json
+import errno
 
-if 'esp' in sys.platform:
-    import ustruct
+# what we're running on is resolved once, in utils, rather than on every call
+from utils import CODES, ON_DEVICE
+
+if ON_DEVICE:
+    import ustruct as _STRUCT
+    _PRINT_EXC = sys.print_exception
+else:
+    import struct as _STRUCT
+    import traceback
+
+    def _PRINT_EXC(e):
+        traceback.print_exc()
+
+# NAWS reports the window as two big-endian shorts. Compile the format once
+# where the struct module can; MicroPython's ustruct has no Struct class
+if hasattr(_STRUCT, "Struct"):
+    _unpack_naws = _STRUCT.Struct('>hh').unpack_from
+else:
+    def _unpack_naws(data):
+        return _STRUCT.unpack_from('>hh', data)
+
+try:
+    from micropython import const
+except ImportError:
+    def const(x):
+        return x
+
+# set to 1 to log Telnet traffic and option negotiation to the console. Left
+# at 0, the logging is compiled out: printing blocks on the UART on the ESP
+_DEBUG = const(0)
+
+# 'poll' reports ready sockets as the socket object itself on MicroPython,
+# but as its file descriptor on CPython
+if ON_DEVICE:
+    def _poll_key(sock):
+        return sock
 else:
-    import struct
+    def _poll_key(sock):
+        return sock.fileno()
 
-from utils import get_color, get_color_list, multiple_replace
+
+# have the TCP stack probe idle clients: after 30 s of silence it sends a
+# keepalive every 10 s, and after 3 unanswered probes the socket reports an
+# error, which is how a client that vanished without closing is noticed.
+# The ESP32 port's setsockopt can't turn keepalive on, so there the server
+# probes clients itself (see '_check_for_disconnected')
+if ON_DEVICE:
+    _KEEPALIVE = ()
+else:
+    _KEEPALIVE = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)] + [
+        (socket.IPPROTO_TCP, getattr(socket, name), value)
+        for name, value in (("TCP_KEEPIDLE", 30), ("TCP_KEEPINTVL", 10),
+                            ("TCP_KEEPCNT", 3))
+        if hasattr(socket, name)]
+
+
+def listen(port=4000):
+    """Creates the tcp socket used to listen for new clients. It can be
+    called before the network interface has an address: connections are
+    accepted as soon as one is assigned.
+    """
+    # create a new tcp socket which will be used to listen for new clients
+    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+    # set a special option on the socket which allows the port to be
+    # immediately without having to wait
+    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+    # bind the socket to an ip address and port. Port 23 is the standard
+    # telnet port which telnet clients will use, however on some platforms
+    # this requires root permissions, so we use a higher arbitrary port
+    # number instead: 4000. Address 0.0.0.0 means that we will bind to all
+    # of the available network interfaces
+    listen_socket.bind(("0.0.0.0", port))
+
+    # set to non-blocking mode. This means that when we call 'accept', it
+    # will return immediately without waiting for a connection
+    listen_socket.setblocking(False)
+
+    # start listening for connections on the socket
+    listen_socket.listen(2)
+    return listen_socket
+
+
+_LF = 10
+
+if hasattr(bytearray, "find"):
+    def _find_special(data, start, end):
+        # index of the first IAC, newline or backspace in data[start:end], or
+        # 'end' if there is none. Each 'find' is a C-level scan, and each one
+        # only has to search up to the closest match found so far
+        for special in (b"\xff", b"\n", b"\x08"):
+            i = data.find(special, start, end)
+            if i != -1:
+                end = i
+        return end
+else:
+    def _find_special(data, start, end):
+        # MicroPython's bytearray has no 'find' but bytes does, so copy the
+        # range once and let the C-level scans run over the copy
+        chunk = bytes(memoryview(data)[start:end])
+        n = end - start
+        for special in (b"\xff", b"\n", b"\x08"):
+            i = chunk.find(special, 0, n)
+            if i != -1:
+                n = i
+        return start + n
+
+
+# every client is read into this one buffer, so polling a socket does not
+# allocate a fresh bytes object for each packet
+_RECV_BUF = bytearray(1024)
+
+# MicroPython sockets only offer the stream 'readinto', which returns None
+# when a non-blocking read has nothing to give
+if ON_DEVICE:
+    def _recv_into(sock, buf):
+        return sock.readinto(buf)
+else:
+    def _recv_into(sock, buf):
+        return sock.recv_into(buf)
+
+
+def _decode_line(buf):
+    # a received line as a str, one character per byte. MicroPython ignores
+    # the codec name and decodes as utf-8, so fall back to mapping each byte
+    # to a character if the client sent something that is not valid utf-8
+    try:
+        return buf.decode("latin1")
+    except UnicodeError:
+        return "".join([chr(c) for c in buf])
+
+
+# terminal lines are wrapped at this many characters
+_WRAP = 80
+
+# (name, escape sequence) for every color code, resolved once at import.
+# Longest names first so that e.g. '%boldoff' is not read as '%bold'
+# followed by 'off'
+_COLOR_TABLE = tuple([(name, CODES[name])
+                      for name in sorted(CODES, key=len, reverse=True)])
+# the same escape sequences as bytes, for color prefixes and resets
+_COLOR_BYTES = dict([(name, esc.encode()) for name, esc in _COLOR_TABLE])
+_RESET = _COLOR_BYTES['reset']
+
+
+def _emit(out, text, col, width):
+    # append 'text' to 'out', starting a new line every 'width' characters.
+    # 'col' is how many characters the current line already holds; the
+    # updated count is returned
+    i = 0
+    n = len(text)
+    # encode the text once and copy each line straight out of it, rather
+    # than slicing and encoding a substring per line. MicroPython encodes as
+    # utf-8 whatever the codec name, so non-ASCII text is still cut by
+    # characters before encoding
+    data = text.encode("latin1")
+    mv = memoryview(data) if len(data) == n else None
+    while width and n - i > width - col:
+        k = i + width - col
+        out.extend(mv[i:k] if mv is not None else text[i:k].encode("latin1"))
+        out.extend(b"\r\n")
+        i = k
+        col = 0
+    out.extend(mv[i:] if mv is not None else text[i:].encode("latin1"))
+    return col + n - i
+
+
+def _render(message, color_enabled, color, line_ending, nowrap):
+    # the bytes sent for a message: the optional color prefix, then the text
+    # with its '%name' color codes substituted (or stripped, if the client
+    # has colors off) and wrapped, all in a single pass, then the line ending
+    # and a color reset
+    out = bytearray()
+    if color and color_enabled:
+        if isinstance(color, list):
+            for c in color:
+                out.extend(_COLOR_BYTES.get(c, b""))
+        else:
+            out.extend(_COLOR_BYTES.get(color, b""))
+
+    width = 0 if nowrap else _WRAP
+    col = 0
+    i = 0
+    n = len(message)
+    while i < n:
+        j = message.find("%", i)
+        if j == -1:
+            j = n
+        # a newline in the text starts a fresh line, so messages made of
+        # several lines wrap each one as if it had been sent on its own
+        k = message.find("\n", i, j)
+        if k != -1:
+            _emit(out, message[i:k], col, width)
+            out.extend(b"\n")
+            col = 0
+            i = k + 1
+            continue
+        col = _emit(out, message[i:j], col, width)
+        i = j
+        if i == n:
+            break
+        for name, escape in _COLOR_TABLE:
+            if message.startswith(name, i + 1):
+                if color_enabled:
+                    col = _emit(out, escape, col, width)
+                i += len(name) + 1
+                break
+        else:
+            # a '%' which doesn't start a color code is plain text
+            col = _emit(out, "%", col, width)
+            i += 1
+
+    out.extend(line_ending.encode("latin1"))
+    if color_enabled:
+        out.extend(_RESET)
+    return out
+
+
+def _handle_mxp(srv, client, support):
+    if support == srv._TN_DO:
+        if _DEBUG:
+            print("MXP Enabled")
+        client.MXP_ENABLED = True
+        # Enable for mushclient "on command"
+        byte_data = bytearray([srv._TN_IAC, srv._TN_SUB_START, srv._MXP, srv._TN_IAC, srv._TN_SUB_END])
+        client.outbuf.extend(byte_data)
+    else:
+        if _DEBUG:
+            print("MXP Disabled")
+        client.MXP_ENABLED = False
+
+
+def _handle_gmcp(srv, client, support):
+    if support == srv._TN_DO:
+        if _DEBUG:
+            print("GMCP Enabled")
+        client.GMCP_ENABLED = True
+        # Enable for mushclient "on command"
+        byte_data = bytearray([srv._TN_IAC, srv._TN_SUB_START, srv._MXP, srv._TN_IAC, srv._TN_SUB_END])
+        client.outbuf.extend(byte_data)
+    else:
+        if _DEBUG:
+            print("GMCP Disabled")
+        client.GMCP_ENABLED = False
+
+
+def _handle_mssp(srv, client, support):
+    if support == srv._TN_DO:
+        srv._send_mssp(client)
 
 
 class MudServer(object):
@@ -44,24 +289,25 @@ class MudServer(object):
         # the ip address of this client
         address = ""
         # holds data send from the client until a full message is received
-        buffer = ""
-        # the last time we checked if the client was still connected
-        lastcheck = 0
+        buffer = None
+
+        # holds data queued to be sent to the client on the next flush
+        outbuf = None
+        # whether poll is also watching the socket for room to write
+        waiting = False
 
         color_enabled = True
+        # set once the client has answered our MXP/GMCP offers
+        MXP_ENABLED = False
+        GMCP_ENABLED = False
         
-        def __init__(self, socket, address, buffer, lastcheck):
+        def __init__(self, socket, address):
             self.socket = socket
             self.address = address
-            self.buffer = buffer
-            self.lastcheck = lastcheck
+            self.buffer = bytearray()
+            self.outbuf = bytearray()
 
 
-    # Used to store different types of occurences
-    _EVENT_NEW_PLAYER = 1
-    _EVENT_PLAYER_LEFT = 2
-    _EVENT_COMMAND = 3
-
     # Different states we can be in while reading data from client
     # See _process_sent_data function
     _READ_STATE_NORMAL = 1
@@ -97,50 +343,81 @@ class MudServer(object):
     _TN_SUB_START = 250
     _TN_SUB_END = 240
 
+    # what to do when the client answers 'will', 'wont', 'do' or 'dont' for
+    # one of the options we negotiate, keyed by option code
+    _OPT_HANDLERS = {_MXP: _handle_mxp, _GMCP: _handle_gmcp,
+                     _MSSP: _handle_mssp}
+
+    # option negotiation sent to every new client in a single write: offer
+    # MSSP, GMCP and MXP and ask the client to report its window size (NAWS)
+    _HANDSHAKE = bytes([_TN_IAC, _TN_WILL, _MSSP,
+                        _TN_IAC, _TN_WILL, _GMCP,
+                        _TN_IAC, _TN_WILL, _MXP,
+                        _TN_IAC, _TN_DO, _NAWS])
+
+    # framing for the subnegotiations we send: the payload goes between a
+    # header and IAC SE
+    _GMCP_HDR = bytes([_TN_IAC, _TN_SUB_START, _GMCP])
+    _MSSP_HDR = bytes([_TN_IAC, _TN_SUB_START, _MSSP])
+    _IAC_SE = bytes([_TN_IAC, _TN_SUB_END])
+
+    # sent by 'remote_echo': with WONT ECHO the client echoes what the user
+    # types, with WILL ECHO it stops (e.g. while a password is typed)
+    _ECHO_ON = bytes([_TN_IAC, _TN_WONT, _ECHO])
+    _ECHO_OFF = bytes([_TN_IAC, _TN_WILL, _ECHO])
+
     # socket used to listen for new clients
     _listen_socket = None
-    # holds info on clients. Maps client id to _Client object
-    _clients = {}
-    # counter for assigning each client a new id
-    _nextid = 0
-    # list of occurences waiting to be handled by the code
-    _events = []
-    # list of newly-added occurences
-    _new_events = []
+    # holds info on clients. A client's id is its index in the list; the
+    # slot of a disconnected client holds None until a new client reuses it
+    _clients = []
+    # ids of empty slots in '_clients', ready to be handed out again
+    _free_ids = []
+    # occurences waiting to be handled by the code, one list per kind:
+    # ids of players who joined, ids of players who left, and
+    # (id, command, params) tuples
+    _joins = []
+    _leaves = []
+    _commands = []
+    # newly-added occurences, in the same three lists
+    _new_joins = []
+    _new_leaves = []
+    _new_commands = []
 
     start_time = time.time()
 
+    # seconds between the liveness probes sent to clients on the ESP
+    _PROBE_INTERVAL = 60
+
 
-    def __init__(self):
+    def __init__(self, listen_socket=None):
         """Constructs the MudServer object and starts listening for
-        new players.
+        new players. A socket already returned by 'listen' can be
+        passed in, so that the port is bound before the server is built.
         """
 
-        self._clients = {}
-        self._nextid = 0
-        self._events = []
-        self._new_events = []
-
-        # create a new tcp socket which will be used to listen for new clients
-        self._listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-        # set a special option on the socket which allows the port to be
-        # immediately without having to wait
-        self._listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-        # bind the socket to an ip address and port. Port 23 is the standard
-        # telnet port which telnet clients will use, however on some platforms
-        # this requires root permissions, so we use a higher arbitrary port
-        # number instead: 1234. Address 0.0.0.0 means that we will bind to all
-        # of the available network interfaces
-        self._listen_socket.bind(("0.0.0.0", 4000))
-
-        # set to non-blocking mode. This means that when we call 'accept', it
-        # will return immediately without waiting for a connection
-        self._listen_socket.setblocking(False)
-
-        # start listening for connections on the socket
-        self._listen_socket.listen(1)
+        self._clients = []
+        self._free_ids = []
+        self._next_probe = time.time() + self._PROBE_INTERVAL
+        self._joins = []
+        self._leaves = []
+        self._commands = []
+        self._new_joins = []
+        self._new_leaves = []
+        self._new_commands = []
+
+        if listen_socket is None:
+            listen_socket = listen()
+        self._listen_socket = listen_socket
+
+        # a single poll object watches the listen socket and every client
+        # socket, so each update costs one call however many players there
+        # are, and only the sockets that are actually ready get handled
+        self._poll = select.poll()
+        self._poll.register(self._listen_socket, select.POLLIN)
+        self._listen_key = _poll_key(self._listen_socket)
+        # maps the poll key of each client socket to the client's id
+        self._poll_clients = {}
 
     def update(self):
         """Checks for new players, disconnected players, and new
@@ -148,29 +425,52 @@ class MudServer(object):
         up-to-date info can be obtained from the 'get_new_players',
         'get_disconnected_players' and 'get_commands' methods.
         It should be called in a loop to keep the game running.
+        The lists those methods return are reused, so they are only
+        valid until the next call.
         """
 
-        # check for new stuff
-        self._check_for_new_connections()
-        self._check_for_disconnected()
-        self._check_for_messages()
+        # send whatever was queued since the last call, then check for new
+        # stuff
+        self.flush()
+        if not _KEEPALIVE:
+            self._check_for_disconnected()
+        self._check_for_activity()
 
-        # move the new events into the main events list so that they can be
+        # move the new events into the main events lists so that they can be
         # obtained with 'get_new_players', 'get_disconnected_players' and
-        # 'get_commands'. The previous events are discarded
-        self._events = list(self._new_events)
-        self._new_events = []
+        # 'get_commands'. The two sets of lists swap places and the previous
+        # events are cleared out, so no new lists are made each tick
+        self._joins, self._new_joins = self._new_joins, self._joins
+        self._leaves, self._new_leaves = self._new_leaves, self._leaves
+        self._commands, self._new_commands = self._new_commands, self._commands
+        self._new_joins.clear()
+        self._new_leaves.clear()
+        self._new_commands.clear()
+
+        # the ids of players who just left are reported by this update, so
+        # they can be given to new players from the next one on
+        self._free_ids.extend(self._leaves)
+
+    def flush(self):
+        """Sends the data queued by 'send_message' and the other send
+        methods, in one write per client. 'update' calls this itself;
+        calling it once all of a tick's messages have been queued gets
+        them to the players without waiting for the next update.
+        """
+        # a failed write only empties the client's own slot, so the list
+        # can be walked as it is
+        for id, cl in enumerate(self._clients):
+            if cl is not None and cl.outbuf:
+                self._flush_client(id, cl)
 
     def get_remote_ip(self, clid):
-        if 'esp' in sys.platform:
+        if ON_DEVICE:
             return 'Unknown IP'
         else:
             cl = self._clients[clid]
             return cl.socket.getpeername()
 
     def disconnect_player(self, clid):
-        cl = self._clients[clid]
-        cl.socket.close()
         self._handle_disconnect(clid)
 
     def get_new_players(self):
@@ -178,29 +478,14 @@ class MudServer(object):
         entered the game since the last call to 'update'. Each item in
         the list is a player id number.
         """
-        retval = []
-        # go through all the events in the main list
-        for ev in self._events:
-            # if the event is a new player occurence, add the info to the list
-            if ev[0] == self._EVENT_NEW_PLAYER:
-                retval.append(ev[1])
-        # return the info list
-        return retval
+        return self._joins
 
     def get_disconnected_players(self):
         """Returns a list containing info on any players that have left
         the game since the last call to 'update'. Each item in the list
         is a player id number.
         """
-        retval = []
-        # go through all the events in the main list
-        for ev in self._events:
-            # if the event is a player disconnect occurence, add the info to
-            # the list
-            if ev[0] == self._EVENT_PLAYER_LEFT:
-                retval.append(ev[1])
-        # return the info list
-        return retval
+        return self._leaves
 
     def get_commands(self):
         """Returns a list containing any commands sent from players
@@ -210,14 +495,7 @@ class MudServer(object):
         they typed), and another string containing the text after the
         command
         """
-        retval = []
-        # go through all the events in the main list
-        for ev in self._events:
-            # if the event is a command occurence, add the info to the list
-            if ev[0] == self._EVENT_COMMAND:
-                retval.append((ev[1], ev[2], ev[3]))
-        # return the info list
-        return retval
+        return self._commands
 
     def send_message(self, to, message, line_ending='\r\n', color=None, nowrap=False):
         """Sends the text in the 'message' parameter to the player with
@@ -228,34 +506,22 @@ class MudServer(object):
         # message on its own line
 
         try:
-            color_enabled = self._clients[to].color_enabled
-        except KeyError:
-            color_enabled = False
+            cl = self._clients[to]
+        except IndexError:
+            cl = None
+        color_enabled = cl is not None and cl.color_enabled
 
-        message = multiple_replace(message, get_color_list(), color_enabled)
-        if nowrap:
-            lines = [message]
-        else:
-            chunks, chunk_size = len(message), 80 #len(x)/4
-            lines = [message[i:i + chunk_size] for i in range(0, chunks, chunk_size)]
-        if color and self._clients[to].color_enabled:
-            if isinstance(color, list):
-                colors = ''.join([get_color(c) for c in color])
-                self._attempt_send(to, colors + '\r\n'.join(lines) + line_ending + get_color('reset'))
-            else:
-                self._attempt_send(to, get_color(color) + '\r\n'.join(lines) + line_ending + get_color('reset'))
-        else:
-            if color_enabled:
-                self._attempt_send(to, '\r\n'.join(lines) + line_ending + get_color('reset'))
-            else:
-                self._attempt_send(to, '\r\n'.join(lines) + line_ending)
+        self._attempt_send(to, _render(message, color_enabled, color,
+                                       line_ending, nowrap))
 
     def shutdown(self):
         """Closes down the server, disconnecting all clients and
         closing the listen socket.
         """
         # for each client
-        for cl in self._clients.values():
+        for cl in self._clients:
+            if cl is None:
+                continue
             # close the socket, disconnecting the client
             cl.socket.shutdown()
             cl.socket.close()
@@ -263,11 +529,20 @@ class MudServer(object):
         self._listen_socket.close()
 
     def send_room(self, clid, num, name, zone, terrain, details, exits, coords):
-        if self._clients[clid].GMCP_ENABLED:
-            room = 'Room.Info {"num": %i, "name":"%s","zone":"%s","terrain":"%s","details":"%s","exits":%s,"coord":%s}' % (num, name, zone, terrain, details, json.dumps(exits), json.dumps(coords))
-            print(room)
+        cl = self._clients[clid]
+        # nothing to send to a client which negotiated neither protocol
+        if not (cl.GMCP_ENABLED or cl.MXP_ENABLED):
+            return
+        if cl.GMCP_ENABLED:
+            # serialize the whole record in one go, so that quotes in any of
+            # the fields are escaped
+            room = 'Room.Info ' + json.dumps({
+                "num": num, "name": name, "zone": zone, "terrain": terrain,
+                "details": details, "exits": exits, "coord": coords})
+            if _DEBUG:
+                print(room)
             self.gmcp_message(clid, room)
-        if self._clients[clid].MXP_ENABLED:
+        if cl.MXP_ENABLED:
             self.mxp_secure(clid, name, 10)
 
     # def send_description(self, clid, description, command=''):
@@ -311,74 +586,88 @@ class MudServer(object):
             self.send_message(clid, ', '.join(list_items))
 
     def gmcp_message(self, clid, message):
-        array = [self._TN_IAC, self._TN_SUB_START, self._GMCP]
-        for char in message:
-            array.append(ord(char))
-        array.append(self._TN_IAC)
-        array.append(self._TN_SUB_END)
-        byte_data = bytearray(array)
-
-        print("SENDING GMCP")
-        print(byte_data)
-        client_socket = self._clients[clid].socket
-        client_socket.sendall(byte_data)
+        out = self._clients[clid].outbuf
+        out.extend(self._GMCP_HDR)
+        out.extend(message.encode("utf-8"))
+        out.extend(self._IAC_SE)
+
+        if _DEBUG:
+            print("SENDING GMCP")
+            print(message)
 
     def mxp_secure(self, clid, message, mxp_code="1"):
-        if 'esp' in sys.platform:
+        if ON_DEVICE:
             bytes_to_send = bytearray("\x1b[{}z{}\x1b[3z\r\n".format(mxp_code, message))
         else:
             bytes_to_send = bytearray("\x1b[{}z{}\x1b[3z\r\n".format(mxp_code, message), 'utf-8')            
-        client_socket = self._clients[clid].socket
-        client_socket.sendall(bytes_to_send)
+        self._clients[clid].outbuf.extend(bytes_to_send)
 
     def raw_send(self, clid, bytes_to_send):
-        client_socket = self._clients[clid].socket
-        client_socket.sendall(bytes_to_send)
+        self._clients[clid].outbuf.extend(bytes_to_send)
 
     def _attempt_send(self, clid, data):
-        # python 2/3 compatability fix - convert non-unicode string to unicode
-        if sys.version < '3' and type(data) != unicode:
-            data = unicode(data, "latin1")
         try:
-            # look up the client in the client map and use 'sendall' to send
-            # the message string on the socket. 'sendall' ensures that all of
-            # the data is sent in one go
-            if sys.version_info != (3, 4, 0):
-                bytes_to_send = bytearray(data, 'latin1')
-            else:
-                bytes_to_send = bytearray(data, "utf-8")
-            #if len(bytes_to_send):
-            #    print(bytes_to_send)
-            client_socket = self._clients[clid].socket
-            client_socket.sendall(bytes_to_send)
-            # KeyError will be raised if there is no client with the given id in
-            # the map
-        except KeyError:
+            # look up the client in the client map and queue the message on
+            # its output buffer; it is written to the socket on the next flush
+            if not isinstance(data, (bytes, bytearray)):
+                data = data.encode("latin1")
+            cl = self._clients[clid]
+            # the slot is empty if the client has disconnected
+            if cl is not None:
+                cl.outbuf.extend(data)
+            # IndexError will be raised if no client was ever given the id
+        except IndexError:
             pass
-        # If there is a connection problem with the client (e.g. they have
-        # disconnected) a socket error will be raised
+        # If the message can't be encoded, drop the client as before
         except Exception as e:
-            if 'esp' not in sys.platform:
-                import traceback
-                traceback.print_exc()
-            else:
-                sys.print_exception(e)
+            _PRINT_EXC(e)
             self._handle_disconnect(clid)
 
-    def _check_for_new_connections(self):
+    def _check_for_activity(self):
+
+        # 'poll' returns the registered sockets which have data waiting to be
+        # read (or a connection waiting to be accepted). We pass in 0 so that
+        # it returns immediately without waiting
+        for key, event in self._poll.poll(0):
+            if key == self._listen_key:
+                self._accept_connection()
+            else:
+                # the client may already have been dropped earlier in this
+                # same pass
+                clid = self._poll_clients.get(key)
+                if clid is not None and event & select.POLLOUT:
+                    self._flush_client(clid, self._clients[clid])
+                    clid = self._poll_clients.get(key)
+                if clid is not None and event & ~select.POLLOUT:
+                    self._read_from_client(clid, self._clients[clid])
 
-        # 'select' is used to check whether there is data waiting to be read
-        # from the socket. We pass in 3 lists of sockets, the first being those
-        # to check for readability. It returns 3 lists, the first being
-        # the sockets that are readable. The last parameter is how long to wait
-        # - we pass in 0 so that it returns immediately without waiting
-        rlist, wlist, xlist = select.select([self._listen_socket], [], [], 0)
+    def _flush_client(self, id, cl):
 
-        # if the socket wasn't in the readable list, there's no data available,
-        # meaning no clients waiting to connect, and so we can exit the method
-        # here
-        if self._listen_socket not in rlist:
-            return
+        try:
+            # write as much of the queued data as the socket will take
+            sent = cl.socket.send(cl.outbuf)
+        except OSError as e:
+            # the socket's send buffer is full: keep everything for later
+            if e.args[0] == errno.EAGAIN:
+                sent = 0
+            # any other error means the client has disconnected
+            else:
+                _PRINT_EXC(e)
+                self._handle_disconnect(id)
+                return
+        cl.outbuf[:sent] = b""
+
+        # while data is left over, also have 'poll' tell us when the socket
+        # can take more, so it is sent as soon as possible
+        waiting = len(cl.outbuf) > 0
+        if waiting != cl.waiting:
+            if waiting:
+                self._poll.modify(cl.socket, select.POLLIN | select.POLLOUT)
+            else:
+                self._poll.modify(cl.socket, select.POLLIN)
+            cl.waiting = waiting
+
+    def _accept_connection(self):
 
         # 'accept' returns a new socket and address info which can be used to
         # communicate with the new client
@@ -388,139 +677,123 @@ class MudServer(object):
         # 'recv' will return immediately without waiting
         joined_socket.setblocking(False)
 
+        # where the port supports it, leave detecting dead connections to
+        # the TCP stack
+        for level, option, value in _KEEPALIVE:
+            try:
+                joined_socket.setsockopt(level, option, value)
+            except OSError:
+                pass
 
         # construct a new _Client object to hold info about the newly connected
-        # client. Use 'nextid' as the new client's id number
-        self._clients[self._nextid] = MudServer._Client(joined_socket, addr[0],
-                                                        "", time.time())
-
-        MSSP_REQUEST = bytearray([self._TN_IAC, self._TN_WILL, self._MSSP])
-        joined_socket.sendall(MSSP_REQUEST)
-
-        GMCP_REQUEST = bytearray([self._TN_IAC, self._TN_WILL, self._GMCP])
-        joined_socket.sendall(GMCP_REQUEST)
-
-        MXP_REQUEST = bytearray([self._TN_IAC, self._TN_WILL, self._MXP])
-        joined_socket.sendall(MXP_REQUEST)
-
-        NAWS_REQUEST = bytes([self._TN_IAC, self._TN_DO, self._NAWS])
-        joined_socket.sendall(NAWS_REQUEST)
+        # client, and give it the slot of a departed client if there is one
+        cl = MudServer._Client(joined_socket, addr[0])
+        cl.outbuf.extend(self._HANDSHAKE)
+        if self._free_ids:
+            clid = self._free_ids.pop()
+            self._clients[clid] = cl
+        else:
+            clid = len(self._clients)
+            self._clients.append(cl)
 
-        # add a new player occurence to the new events list with the player's
-        # id number
-        self._new_events.append((self._EVENT_NEW_PLAYER, self._nextid))
+        # watch the new socket for incoming data along with the others
+        self._poll.register(joined_socket, select.POLLIN)
+        self._poll_clients[_poll_key(joined_socket)] = clid
 
-        # add 1 to 'nextid' so that the next client to connect will get a
-        # unique id number
-        self._nextid += 1
+        # add the player's id number to the new joins list
+        self._new_joins.append(clid)
 
     def _check_for_disconnected(self):
 
-        # go through all the clients
-        for id, cl in list(self._clients.items()):
-
-            # if we last checked the client less than 5 seconds ago, skip this
-            # client and move on to the next one
-            if time.time() - cl.lastcheck < 5.0:
-                continue
-
-            # send the client an invisible character. It doesn't actually
-            # matter what we send, we're really just checking that data can
-            # still be written to the socket. If it can't, an error will be
-            # raised and we'll know that the client has disconnected.
-            self._attempt_send(id, "\x00")
-
-            # update the last check time
-            cl.lastcheck = time.time()
+        # without TCP keepalive, a client that vanished without closing the
+        # connection is only noticed when we write to it. So every so often
+        # queue an invisible NUL byte for each client: once the peer has gone,
+        # writing to its socket fails and the client is disconnected
+        now = time.time()
+        if now < self._next_probe:
+            return
+        self._next_probe = now + self._PROBE_INTERVAL
+        for cl in self._clients:
+            if cl is not None:
+                cl.outbuf.extend(b"\x00")
 
-    def _check_for_messages(self):
+    def _read_from_client(self, id, cl):
 
-        # go through all the clients
-        for id, cl in list(self._clients.items()):
+        try:
+            # read data from the socket into the shared receive buffer, using
+            # a max length of 1024
+            n = _recv_into(cl.socket, _RECV_BUF)
+            if n is None:
+                return
+
+            # a readable socket with no data means the client has closed
+            # the connection
+            if not n:
+                self._handle_disconnect(id)
+                return
 
-            # we use 'select' to test whether there is data waiting to be read
-            # from the client socket. The function takes 3 lists of sockets,
-            # the first being those to test for readability. It returns 3 list
-            # of sockets, the first being those that are actually readable.
-            rlist, wlist, xlist = select.select([cl.socket], [], [], 0)
+            # process the data, stripping out any special Telnet commands
+            message = self._process_sent_data(cl, _RECV_BUF, n)
 
-            # if the client socket wasn't in the readable list, there is no
-            # new data from the client - we can skip it and move on to the next
-            # one
-            if cl.socket not in rlist:
-                continue
+            # if there was a message in the data
+            if message:
+                if _DEBUG:
+                    print(message)
+                # remove any spaces, tabs etc from the start and end of
+                # the message
+                message = message.strip()
 
-            try:
-                # read data from the socket, using a max length of 4096
-                data = cl.socket.recv(1024)
+                # separate the message into the command (the first word)
+                # and its parameters (the rest of the message)
+                command, _, params = message.partition(" ")
 
-                # process the data, stripping out any special Telnet commands
-                message = self._process_sent_data(cl, data)
+                # add a command occurence to the new commands list with the
+                # player's id number, the command and its parameters
+                self._new_commands.append((id, command.lower(), params))
 
-                # if there was a message in the data
-                if message:
-                    print(message)
-                    # remove any spaces, tabs etc from the start and end of
-                    # the message
-                    message = message.strip()
-
-                    # separate the message into the command (the first word)
-                    # and its parameters (the rest of the message)
-                    command, params = (message.split(" ", 1) + ["", ""])[:2]
-
-                    # add a command occurence to the new events list with the
-                    # player's id number, the command and its parameters
-                    self._new_events.append((self._EVENT_COMMAND, id,
-                                             command.lower(), params))
-
-            # if there is a problem reading from the socket (e.g. the client
-            # has disconnected) a socket error will be raised
-            except Exception as e:
-                if 'esp' not in sys.platform:
-                    import traceback
-                    traceback.print_exc()
-                else:
-                    sys.print_exception(e)
-                self._handle_disconnect(id)
+        # if there is a problem reading from the socket (e.g. the client
+        # has disconnected) a socket error will be raised
+        except Exception as e:
+            _PRINT_EXC(e)
+            self._handle_disconnect(id)
 
     def _handle_disconnect(self, clid):
 
-        # remove the client from the clients map
-        del(self._clients[clid])
+        # empty the client's slot in the clients list
+        cl = self._clients[clid]
+        self._clients[clid] = None
+
+        # stop watching its socket and make sure it is closed
+        del self._poll_clients[_poll_key(cl.socket)]
+        self._poll.unregister(cl.socket)
+        cl.socket.close()
 
-        # add a 'player left' occurence to the new events list, with the
-        # player's id number
-        self._new_events.append((self._EVENT_PLAYER_LEFT, clid))
+        # add the player's id number to the new leaves list
+        self._new_leaves.append(clid)
 
     def remote_echo(self, clid, enable=True):
         if enable:
-            bytes_to_send = bytearray([self._TN_IAC, self._TN_WONT, self._ECHO])
+            bytes_to_send = self._ECHO_ON
         else:
-            bytes_to_send = bytearray([self._TN_IAC, self._TN_WILL, self._ECHO])
+            bytes_to_send = self._ECHO_OFF
         try:
-            client_socket = self._clients[clid].socket
-            client_socket.sendall(bytes_to_send)
+            self._clients[clid].outbuf.extend(bytes_to_send)
         except:
             pass
 
     def _send_mssp(self, client):
-        byte_data = bytearray([self._TN_IAC, self._TN_SUB_START, self._MSSP, self._MSSP_VAR])
-        byte_data.extend(b'PLAYERS')
-        byte_data.append(self._MSSP_VAL)
-        byte_data.extend(str(len(self._clients)).encode())
-        byte_data.append(self._MSSP_VAR)
-        byte_data.extend(b'UPTIME')
-        byte_data.append(self._MSSP_VAL)
-        byte_data.extend(str(time.time() - self.start_time).encode())
-        byte_data.append(self._MSSP_VAR)
-        byte_data.extend(b'NAME')
-        byte_data.append(self._MSSP_VAL)
-        byte_data.extend(b'WeeMud')
-        byte_data.extend([self._TN_IAC, self._TN_SUB_END])
-
-        print("SENDING MSSP")
-        print(byte_data)
-        client.socket.sendall(byte_data)
+        # each variable is MSSP_VAR (1), its name, MSSP_VAL (2), its value
+        byte_data = b"".join((
+            self._MSSP_HDR,
+            b"\x01PLAYERS\x02", str(len(self._clients) - self._clients.count(None)).encode(),
+            b"\x01UPTIME\x02", str(time.time() - self.start_time).encode(),
+            b"\x01NAME\x02WeeMud",
+            self._IAC_SE))
+
+        if _DEBUG:
+            print("SENDING MSSP")
+            print(byte_data)
+        client.outbuf.extend(byte_data)
 
     # def _send_msdp_array(self, client, var, vals):
     #     byte_data = bytearray([self._TN_IAC, self._TN_SUB_START, self._MSDP, self._MSDP_VAR])
@@ -541,7 +814,7 @@ class MudServer(object):
     #     print(byte_data.hex())
     #     client.socket.sendall(byte_data)
 
-    def _process_sent_data(self, client, data):
+    def _process_sent_data(self, client, data, n):
 
         # the Telnet protocol allows special command codes to be inserted into
         # messages. For our very simple server we don't need to response to
@@ -554,18 +827,34 @@ class MudServer(object):
         message = None
         state = self._READ_STATE_NORMAL
 
-        out = ""
-        out2 = ""
-        for b in data:
-            out += " " + str(b)
-            out2 += " " + chr(b)
-        print(out)
-        print(out2)
+        if _DEBUG:
+            out = ""
+            out2 = ""
+            for b in data[:n]:
+                out += " " + str(b)
+                out2 += " " + chr(b)
+            print(out)
+            print(out2)
         option_data = bytearray()
         option_state = 0
         option_support = 0
-        # go through the data a character at a time
-        for c in data:
+        mv = memoryview(data)
+        i = 0
+        # go through the data a run of plain text or a single special
+        # character at a time
+        while i < n:
+
+            # in the normal state, copy everything up to the next special
+            # character (IAC, newline or backspace) into the buffer in one go
+            if state == self._READ_STATE_NORMAL:
+                j = _find_special(data, i, n)
+                if j > i:
+                    client.buffer.extend(mv[i:j])
+                    i = j
+                    continue
+
+            c = data[i]
+            i += 1
 
             # handle the character differently depending on the state we're in:
 
@@ -581,21 +870,16 @@ class MudServer(object):
                 # if we get a newline character, this is the end of the
                 # message. Set 'message' to the contents of the buffer and
                 # clear the buffer
-                elif chr(c) == "\n":
-                    message = client.buffer
-                    client.buffer = ""
+                elif c == _LF:
+                    message = _decode_line(client.buffer)
+                    client.buffer = bytearray()
 
                 # some telnet clients send the characters as soon as the user
                 # types them. So if we get a backspace character, this is where
                 # the user has deleted a character and we should delete the
                 # last character from the buffer.
-                elif chr(c) == "\x08":
-                    client.buffer = client.buffer[:-1]
-
-                # otherwise it's just a regular character - add it to the
-                # buffer where we're building up the received message
                 else:
-                    client.buffer += chr(c)
+                    client.buffer[-1:] = b""
 
             # command state
             elif state == self._READ_STATE_COMMAND:
@@ -615,35 +899,6 @@ class MudServer(object):
                     option_support = c
                     state = self._READ_STATE_COMMAND
 
-                elif c == self._MXP:
-                    if option_support == self._TN_DO:
-                        print("MXP Enabled")
-                        client.MXP_ENABLED = True
-                        # Enable for mushclient "on command"
-                        byte_data = bytearray([self._TN_IAC, self._TN_SUB_START, self._MXP, self._TN_IAC, self._TN_SUB_END])
-                        client.socket.sendall(byte_data)
-                    else:
-                        print("MXP Disabled")
-                        client.MXP_ENABLED = False
-                    state = self._READ_STATE_NORMAL
-
-                elif c == self._GMCP:
-                    if option_support == self._TN_DO:
-                        print("GMCP Enabled")
-                        client.GMCP_ENABLED = True
-                        # Enable for mushclient "on command"
-                        byte_data = bytearray([self._TN_IAC, self._TN_SUB_START, self._MXP, self._TN_IAC, self._TN_SUB_END])
-                        client.socket.sendall(byte_data)
-                    else:
-                        print("GMCP Disabled")
-                        client.GMCP_ENABLED = False
-                    state = self._READ_STATE_NORMAL
-
-                elif c == self._MSSP:
-                    if option_support == self._TN_DO:
-                        self._send_mssp(client)
-                    state = self._READ_STATE_NORMAL
-
                 # elif c == self._MSDP:
                 #     if option_support == self._TN_DO:
                 #         client.MSDP_ENABLED = True
@@ -651,9 +906,13 @@ class MudServer(object):
                 #         client.MSDP_ENABLED = False
                 #     state = self._READ_STATE_NORMAL
 
-                # for all other command codes, there is no accompanying data so
-                # we can return to 'normal' state.
+                # an option we negotiate is handled by its entry in the option
+                # table. Other command codes have no accompanying data, so
+                # either way we can return to 'normal' state.
                 else:
+                    handler = self._OPT_HANDLERS.get(c)
+                    if handler:
+                        handler(self, client, option_support)
                     state = self._READ_STATE_NORMAL
 
             # subnegotiation state
@@ -667,15 +926,13 @@ class MudServer(object):
                         height = 30
                         width = 100
                         try:
-                            if 'esp' in sys.platform:
-                                height, width = ustruct.unpack('>hh', option_data)
-                            else:
-                                height, width = struct.unpack('>hh', option_data)
+                            height, width = _unpack_naws(option_data)
                             if height > 0:
                                 client.height = height
                             if width > 0:
                                 client.width = width
-                            print("Got NAWS Width: %d  Height: %d" % (client.width, client.height))
+                            if _DEBUG:
+                                print("Got NAWS Width: %d  Height: %d" % (client.width, client.height))
                         except:
                             pass
                         option_state = 0
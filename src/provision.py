@@ -0,0 +1,16 @@
+# Stores the credentials of the WiFi network to join in NVS, where main.py
+# reads them from in station mode. Edit and run once on the board, e.g.
+#   mpremote run provision.py
+# There is no need to copy this file to the board.
+import esp32
+
+nvs = esp32.NVS('net')
+nvs.set_blob('ssid', b'XXX')
+nvs.set_blob('psk', b'XXX')
+# the cached DHCP lease belongs to the previous network, so drop it
+try:
+    nvs.erase_key('lease')
+except OSError:
+    pass
+nvs.commit()
+print('WiFi credentials stored')
@@ -25,10 +25,13 @@ import time
 import socket
 import sys
 import json
+import asyncio
 
-if sys.platform in ["esp", "WiPy"]:
+# on the microcontroller the heap is small, so it is collected straight after
+# each save file is written rather than left fragmented by the serializer
+from utils import ON_DEVICE
+if ON_DEVICE:
     import gc
-    import micropython
 # import the MUD server class
 from mudserver import MudServer
 
@@ -39,313 +42,420 @@ from rms import rooms
 # stores the players in the game
 players = {}
 
-# start the server
-mud = MudServer()
-print("== MUD Starting ==")
+# the ids of the players in each room, so that messages for a room only go
+# through the players there rather than everyone in the game
+rooms_occupants = {}
+
+# the list of exits shown by 'look' for each room, built the first time the
+# room is looked at and again only after 'link' changes its exits. It is kept
+# out of 'rooms' so that it isn't saved with them
+exits_strs = {}
+
+# seconds between automatic saves of the players and rooms
+SAVE_INTERVAL = 300
+# whether the players and the rooms have changed since they were last saved;
+# a save skips writing whichever hasn't
+players_dirty = True
+rooms_dirty = True
+# save files are written as compact JSON, without the spaces after commas and
+# colons. MicroPython's json can't indent at all
+JSON_SEPARATORS = (",", ":")
+
+# seconds the game loop sleeps between polls while the players are idle. The
+# sleep starts short after any activity, so replies stay quick, and doubles
+# on each quiet pass up to the maximum, so an empty server wakes about once a
+# second
+IDLE_SLEEP_MIN = 0.05
+IDLE_SLEEP_MAX = 1
+
+# the server, created when the game loop starts
+mud = None
+
+# fixed text sent to players, built once when the module is loaded
+LOOK_FMT = "\n==== {} ====\n\r\n{}\n\r\n> Players here: {}\r\n> Exits are: {}\n"
+WELCOME_FMT = "Welcome to the game, {}. Type 'help' for a list of commands. Have fun!"
+EMPTY_ROOM_FMT = "This is the empty '{}' room.\nSomeone should change this name."
+UNKNOWN_EXIT_FMT = "Unknown exit '{}'"
+UNKNOWN_COMMAND_FMT = "Unknown command '{}'"
+
+# the reply to 'help', sent as a single message
+HELP_TEXT = "\r\n".join([
+    "Commands - explore:",
+    "  say <message>  - Says something out loud, e.g. 'say Hello'",
+    "  look, l        - Examines the surroundings, e.g.\n    'look'",
+    "  : <emote>      - broadcasts an emote to the room",
+    "  go <exit>      - Moves through the exit specified, e.g.\n    'go outside'",
+    "  goto      - you go to one of the rooms",
+    "\nCommands - build:",
+    "  create      - creates a new room. eg:\n    'create the office'",
+    "  link  A - B - links current room to target room, eg:",
+    "    'link the office - office door'",
+    "  describe    - changes the description of the current room",
+    "  review      - changes the description of the current room",
+])
 
 
 def look(id):
     # store the player's current room
     rm = rooms[players[id]["room"]]
 
-    # send the player back the description of their current room
-    mud.send_message(id, "\n==== "+players[id]["room"]+" ====\n")
-    mud.send_message(id, rm["description"]+"\n")
-
     playershere = []
-    # go through every player in the game
-    for pid, pl in players.items():
-        # if they're in the same room as the player
-        if players[pid]["room"] == players[id]["room"]:
-            # ... and they have a name to be shown
-            if players[pid]["name"] is not None:
-                # add their name to the list
-                playershere.append(players[pid]["name"])
-
-    # send player a message containing the list of players in the room
-    mud.send_message(id, "> Players here: {}".format(", ".join(playershere)))
-
-    # send player a message containing the list of exits from this room
-    mud.send_message(id, "> Exits are: {}\n".format(", ".join(rm["exits"])))
+    # go through every player in the same room as the player
+    for pid in rooms_occupants[players[id]["room"]]:
+        # add their name to the list
+        playershere.append(players[pid]["name"])
+
+    # send the player back the description of their current room, the list
+    # of players in the room and the list of exits from it, in one message
+    exits = exits_strs.get(players[id]["room"])
+    if exits is None:
+        exits = exits_strs[players[id]["room"]] = ", ".join(rm["exits"])
+
+    mud.send_message(id, LOOK_FMT.format(players[id]["room"], rm["description"],
+                                         ", ".join(playershere), exits))
     return 1
 
-def save():
-    players_json = json.dumps(players, indent=3)
+def move_player(id, room):
+    # put the player in 'room', taking them out of the one they were in
+    global players_dirty
+    players_dirty = True
+    old = players[id]["room"]
+    if old is not None:
+        rooms_occupants[old].discard(id)
+    players[id]["room"] = room
+    rooms_occupants.setdefault(room, set()).add(id)
+
+def save_players():
+    global players_dirty
+    if not players_dirty:
+        return
+    # write the players into the file one at a time, so that only one
+    # player's worth of JSON is ever held in memory. The places a player
+    # remembers are kept as a set, which JSON can't hold (and MicroPython's
+    # json has no 'default' hook), so each such player is saved from a copy
+    # with them as a list
     with open("players_backup.json","w") as f:
-        f.write(players_json)
-    rooms_json = json.dumps(rooms, indent=3)
+        sep = "{"
+        for pid, pl in players.items():
+            if "remember" in pl:
+                pl = dict(pl)
+                pl["remember"] = sorted(pl["remember"])
+            f.write(sep)
+            f.write(json.dumps(str(pid)))
+            f.write(":")
+            json.dump(pl, f, separators=JSON_SEPARATORS)
+            sep = ","
+        f.write("}" if players else "{}")
+    players_dirty = False
+    if ON_DEVICE:
+        gc.collect()
+
+def save_rooms():
+    global rooms_dirty
+    if not rooms_dirty:
+        return
     with open("rooms_backup.json","w") as f:
-        f.write(rooms_json)
+        json.dump(rooms, f, separators=JSON_SEPARATORS)
+    rooms_dirty = False
+    if ON_DEVICE:
+        gc.collect()
+
+def save():
+    save_players()
+    save_rooms()
     return 1
 
-# main game loop. We loop forever (i.e. until the program is terminated)
-countTicks = 0
-
-while True:
-
-    # pause for 1/5 of a second on each loop, so that we don't constantly
-    # use 100% CPU time
-    time.sleep(0.2)
-    countTicks =+1
-    countTicks = countTicks % 1500  # 1500*0.2 = 300s = 5 mins
-    if not countTicks:
-        save()
-    # 'update' must be called in the loop to keep the game running and give
-    # us up-to-date information
-    mud.update()
-
-    # go through any newly connected players
-    for id in mud.get_new_players():
-
-        # add the new player to the dictionary, noting that they've not been
-        # named yet.
-        # The dictionary key is the player's id number. We set their room to
-        # None initially until they have entered a name
-        # Try adding more player stats - level, gold, inventory, etc
-        players[id] = {
-            "name": None,
-            "room": None,
+# 'goto' command
+def cmd_goto(id, params):
+    name = params.strip()
+    if name in rooms:
+        move_player(id, name)
+        mud.send_message(id, "You arrive in the place called '"+name+"'.")
+        look(id)
+        players[id]["remember"].add(name)
+    else:
+        mud.send_message(id, "It seems you can't reach there.")
+
+# 'help' command
+def cmd_help(id, params):
+    # send the player back the list of possible commands
+    mud.send_message(id, HELP_TEXT)
+
+# 'say' command
+def cmd_say(id, params):
+    # go through every player in the same room as the player
+    for pid in rooms_occupants[players[id]["room"]]:
+        # send them a message telling them what the player said
+        mud.send_message(
+            pid, "{} says: {}".format(players[id]["name"], params)
+        )
+
+# ':' command
+def cmd_emote(id, params):
+    # go through every player in the same room as the player
+    for pid in rooms_occupants[players[id]["room"]]:
+        # send them a message telling them what the player did
+        mud.send_message(
+            pid, "{} {}".format(players[id]["name"], params)
+        )
+
+# 'create' command
+def cmd_create(id, params):
+    global rooms_dirty
+    name = params.strip()
+    if params in rooms:
+        mud.send_message(id, ">> The room '" + params + "' already exists.")
+    else:
+        rooms[params] = {
+            "description": EMPTY_ROOM_FMT.format(params),
+            "exits": {},
         }
+        rooms_dirty = True
+        mud.send_message(id, ">> You create the room '" + params + "'.")
+
+# 'describe' command
+def cmd_describe(id, params):
+    global rooms_dirty
+    desc = params.strip()
+     # store the player's current room
+    if players[id]["room"] == "Tavern":
+        mud.send_message(id, ">> This one is quite fixed =)")
+    else:
+        rm = rooms[players[id]["room"]]
+        rm["description"] = desc
+        rooms_dirty = True
+        mud.send_message(id, ">> You reshaped the current room.")
+
+# 'link' command
+def cmd_link(id, params):
+    global rooms_dirty
+    links = [x.strip() for x in params.strip().split(" - ")]
+    if len(links) == 2:
+        # store the player's current room
+        if not links[0] in rooms:
+            mud.send_message(id, ">> You cannot point to the '"+links[0]+"' room.")
+        else:
+            rm = players[id]["room"]
+            # 'go' looks exits up in lower case, so store them that way
+            rooms[rm]["exits"][links[1].lower()] = links[0]
+            exits_strs.pop(rm, None)
+            rooms_dirty = True
+            mud.send_message(id, ">> You connected the current room to '"+links[0]+"' through the '"+links[1]+"' exit.")
+    else:
+        mud.send_message(id, ">> You cannot point to the '"+links[0]+"' room.\nUse 'link Tavern - enter portal")
+
+# 'look' command
+def cmd_look(id, params):
+    look(id)
+
+# 'save' command
+def cmd_save(id, params):
+    save()
+    mud.send_message(id, ">> You feel the world is getting more stable")
+
+# 'go' command
+def cmd_go(id, params):
+    # store the exit name
+    ex = params.lower()
 
-        # send the new player a prompt for their name
-        mud.send_message(id, "What is your name?")
-
-    # go through any recently disconnected players
-    for id in mud.get_disconnected_players():
-
-        # if for any reason the player isn't in the player map, skip them and
-        # move on to the next one
-        if id not in players:
-            continue
+    # store the player's current room
+    rm = rooms[players[id]["room"]]
 
-        # go through all the players in the game
-        for pid, pl in players.items():
-            # send each player a message to tell them about the diconnected
-            # player
-            mud.send_message(pid, "{} quit the game".format(players[id]["name"]))
-
-        # remove the player's entry in the player dictionary
-        del players[id]
-
-    # go through any new commands sent from players
-    for id, command, params in mud.get_commands():
-        print("id, command, params", id, command, params)
-        # if for any reason the player isn't in the player map, skip them and
-        # move on to the next one
-        if id not in players:
-            continue
-        with open("log.log","a") as f:
-            f.write("- "+str(id)+" __ "+str(command)+" __ "+str(params)+"\n")
-        # if the player hasn't given their name yet, use this first command as
-        # their name and move them to the starting room.
-        if players[id]["name"] is None:
-
-            players[id]["name"] = command
-            players[id]["room"] = "Tavern"
-            players[id]["remember"] = ["Tavern"]
-            # go through all the players in the game
-            for pid, pl in players.items():
-                # send each player a message to tell them about the new player
-                mud.send_message(pid, "{} entered the game".format(players[id]["name"]))
-
-            # send the new player a welcome message
+    # if the specified exit is found in the room's exits list
+    if ex in rm["exits"]:
+
+        # go through all the players in the same room
+        for pid in rooms_occupants[players[id]["room"]]:
+            # if it isn't the player sending the command
+            if pid != id:
+                # send them a message telling them that the player
+                # left the room
+                mud.send_message(
+                    pid, "{} left via exit '{}'".format(players[id]["name"], ex)
+                )
+
+        # update the player's current room to the one the exit leads to
+        move_player(id, rm["exits"][ex])
+        players[id]["remember"].add(players[id]["room"])
+
+        # go through all the players in the same (new) room
+        for pid in rooms_occupants[players[id]["room"]]:
+            # if it isn't the player sending the command
+            if pid != id:
+                # send them a message telling them that the player
+                # entered the room
+                mud.send_message(
+                    pid,
+                    "{} arrived via exit '{}'".format(players[id]["name"], ex),
+                )
+
+        # send the player a message telling them where they are now
+        mud.send_message(id, "You arrive at '{}'".format(players[id]["room"]))
+        look(id)
+    # the specified exit wasn't found in the current room
+    else:
+        # send back an 'unknown exit' message
+        mud.send_message(id, UNKNOWN_EXIT_FMT.format(ex))
+
+# 'remember' command
+def cmd_remember(id, params):
+    mud.send_message(id, "\nYou remember the following places:\n* "+"\n* ".join(sorted(players[id]["remember"]))+"\n")
+
+# 'review' command
+def cmd_review(id, params):
+    global rooms_dirty
+    rooms[players[id]["room"]]["description"] = params
+    rooms_dirty = True
+    mud.send_message(
+        id, "You remodel the '{}' room.".format(players[id]["room"])
+    )
+    # go through all the players in the same room
+    for pid in rooms_occupants[players[id]["room"]]:
+        # if it isn't the player sending the command
+        if pid != id:
+            # send them a message telling them that the player
+            # remodeled the room
             mud.send_message(
-                id,
-                "Welcome to the game, {}. ".format(players[id]["name"])
-                + "Type 'help' for a list of commands. Have fun!",
+                pid, "{} remodeled the room.".format(players[id]["name"])
             )
-            look(id)
-            # send the new player the description of their current room
-            mud.send_message(id, rooms[players[id]["room"]]["description"])
-
-        # each of the possible commands is handled below. Try adding new
-        # commands to the game!
-
-        # 'help' command
-        elif command == "goto":
-            name = params.strip()
-            if name in rooms.keys():
-                players[id]["room"] = name
-                mud.send_message(id, "You arrive in the place called '"+name+"'.")
-                look(id)
-                if name not in players[id]["remember"]:
-                    players[id]["remember"].append(players[id]["room"])
-                    players[id]["remember"] = list(set(players[id]["remember"]))
-            else:
-                mud.send_message(id, "It seems you can't reach there.")
-        elif command == "help":
-
-            # send the player back the list of possible commands
-            mud.send_message(id, "Commands - explore:")
-            mud.send_message(
-                id, "  say <message>  - Says something out loud, " + "e.g. 'say Hello'"
-            )
-            mud.send_message(
-                id, "  look, l        - Examines the " + "surroundings, e.g.\n    'look'"
-            )
-            mud.send_message(
-                id, "  : <emote>      - broadcasts an emote to the room"
-            )
-            mud.send_message(
-                id,
-                "  go <exit>      - Moves through the exit "
-                + "specified, e.g.\n    'go outside'",
-            )
-            mud.send_message(
-                id, "  goto      - you go to one of the rooms"
-            )
-            mud.send_message(id, "\nCommands - build:")
-            mud.send_message(
-                id, "  create      - creates a new room. eg:\n    'create the office'"
-            )      
-            mud.send_message(
-                id, "  link  A - B - links current room to target room, eg:"
-            )  
-            mud.send_message(id, "    'link the office - office door'")
-            mud.send_message(
-                id, "  describe    - changes the description of the current room"
-            )        
-            mud.send_message(
-                id, "  review      - changes the description of the current room"
-            )   
-        # 'say' command
-        elif command == "say":
-
-            # go through every player in the game
-            for pid, pl in players.items():
-                # if they're in the same room as the player
-                if players[pid]["room"] == players[id]["room"]:
-                    # send them a message telling them what the player said
-                    mud.send_message(
-                        pid, "{} says: {}".format(players[id]["name"], params)
-                    )
-
-        elif command == ":":
-
-            # go through every player in the game
-            for pid, pl in players.items():
-                # if they're in the same room as the player
-                if players[pid]["room"] == players[id]["room"]:
-                    # send them a message telling them what the player said
-                    mud.send_message(
-                        pid, "{} {}".format(players[id]["name"], params)
-                    )
-
-
-        # 'look' command
-        elif command == "create":
-            name = params.strip()
-            if params not in rooms.keys():
-                rooms[params] = {
-                    "description": "This is the empty '" + params + "' room.\nSomeone should change this name.",
-                    "exits": {},
-                }
-                mud.send_message(id, ">> You create the room '" + params + "'.")
-            else:
-                mud.send_message(id, ">> The room '" + params + "' already exists.")
-
-        elif command == "describe":
-            desc = params.strip()
-             # store the player's current room
-            if players[id]["room"] == "Tavern":
-                mud.send_message(id, ">> This one is quite fixed =)")
-            else:
-                rm = rooms[players[id]["room"]]
-                rm["description"] = desc
-                mud.send_message(id, ">> You reshaped the current room.")
-
-        elif command == "link":
-            links = [x.strip() for x in params.strip().split(" - ")]
-            if len(links) == 2:
-                # store the player's current room
-                if not links[0] in rooms.keys():
-                    mud.send_message(id, ">> You cannot point to the '"+links[0]+"' room.")
-                else:
-                    rm = players[id]["room"]
-                    EXITS = rooms[rm]["exits"]
-                    rooms[rm]["exits"][links[1]] = links[0]
-                    mud.send_message(id, ">> You connected the current room to '"+links[0]+"' through the '"+links[1]+"' exit.")
-            else:
-                mud.send_message(id, ">> You cannot point to the '"+links[0]+"' room.\nUse 'link Tavern - enter portal")
-
-        elif command in ["look","l"]:
-
-            look(id)
-
-        elif command in ["save"]:
-            save()
-            mud.send_message(id, ">> You feel the world is getting more stable")
-
-        # 'go' command
-        elif command == "go":
-
-            # store the exit name
-            ex = params.lower()
-
-            # store the player's current room
-            rm = rooms[players[id]["room"]]
-
-            # if the specified exit is found in the room's exits list
-            if ex in rm["exits"]:
 
+# the function handling each command, so that a command is found with one
+# lookup rather than by comparing it with every command name in turn
+COMMANDS = {
+    "goto": cmd_goto,
+    "help": cmd_help,
+    "say": cmd_say,
+    ":": cmd_emote,
+    "create": cmd_create,
+    "describe": cmd_describe,
+    "link": cmd_link,
+    "look": cmd_look,
+    "l": cmd_look,
+    "save": cmd_save,
+    "go": cmd_go,
+    "remember": cmd_remember,
+    "review": cmd_review,
+}
+
+async def main(listen_socket=None):
+    global mud, players_dirty
+
+    # start the server
+    mud = MudServer(listen_socket)
+    print("== MUD Starting ==")
+
+    # the game is saved every 5 minutes
+    next_save = time.time() + SAVE_INTERVAL
+    # the parts of an autosave still to be written
+    saving = []
+    # how long to sleep before the next poll
+    idle = 0
+
+    # main game loop. We loop forever (i.e. until the program is terminated)
+    while True:
+
+        # let other tasks on the event loop run. Once something happens, go
+        # round again straight away; while nothing does, back off between
+        # polls
+        await asyncio.sleep(0 if saving else idle)
+
+        # 'update' must be called in the loop to keep the game running and give
+        # us up-to-date information
+        mud.update()
+        if (mud.get_new_players() or mud.get_disconnected_players()
+                or mud.get_commands()):
+            idle = 0
+        else:
+            idle = min(IDLE_SLEEP_MAX, max(IDLE_SLEEP_MIN, idle * 2))
+
+        # write an autosave one file per pass of the loop, so that players'
+        # commands are still handled in between
+        if not saving and time.time() >= next_save:
+            saving = [save_rooms, save_players]
+            next_save += SAVE_INTERVAL
+        if saving:
+            saving.pop()()
+
+        # go through any newly connected players
+        for id in mud.get_new_players():
+
+            # add the new player to the dictionary, noting that they've not been
+            # named yet.
+            # The dictionary key is the player's id number. We set their room to
+            # None initially until they have entered a name
+            # Try adding more player stats - level, gold, inventory, etc
+            players[id] = {
+                "name": None,
+                "room": None,
+            }
+            players_dirty = True
+
+            # send the new player a prompt for their name
+            mud.send_message(id, "What is your name?")
+
+        # go through any recently disconnected players
+        for id in mud.get_disconnected_players():
+
+            # if for any reason the player isn't in the player map, skip them and
+            # move on to the next one
+            if id not in players:
+                continue
+
+            # take the player out of their room, and tell the players still
+            # there that they left. A player who never gave a name isn't in
+            # any room yet
+            rm = players[id]["room"]
+            if rm is not None:
+                occupants = rooms_occupants[rm]
+                occupants.discard(id)
+                for pid in occupants:
+                    mud.send_message(pid, "{} quit the game".format(players[id]["name"]))
+
+            # remove the player's entry in the player dictionary
+            del players[id]
+            players_dirty = True
+
+        # go through any new commands sent from players
+        for id, command, params in mud.get_commands():
+            print("id, command, params", id, command, params)
+            # if for any reason the player isn't in the player map, skip them and
+            # move on to the next one
+            if id not in players:
+                continue
+            with open("log.log","a") as f:
+                f.write("- "+str(id)+" __ "+str(command)+" __ "+str(params)+"\n")
+            # if the player hasn't given their name yet, use this first command as
+            # their name and move them to the starting room.
+            if players[id]["name"] is None:
+
+                players[id]["name"] = command
+                move_player(id, "Tavern")
+                players[id]["remember"] = {"Tavern"}
                 # go through all the players in the game
                 for pid, pl in players.items():
-                    # if player is in the same room and isn't the player
-                    # sending the command
-                    if players[pid]["room"] == players[id]["room"] and pid != id:
-                        # send them a message telling them that the player
-                        # left the room
-                        mud.send_message(
-                            pid, "{} left via exit '{}'".format(players[id]["name"], ex)
-                        )
-
-                # update the player's current room to the one the exit leads to
-                players[id]["room"] = rm["exits"][ex]
-                rm = rooms[players[id]["room"]]
-                if rm not in players[id]["remember"]:
-                    players[id]["remember"].append(players[id]["room"])
-                    players[id]["remember"] = list(set(players[id]["remember"]))
+                    # send each player a message to tell them about the new player
+                    mud.send_message(pid, "{} entered the game".format(players[id]["name"]))
 
-                # go through all the players in the game
-                for pid, pl in players.items():
-                    # if player is in the same (new) room and isn't the player
-                    # sending the command
-                    if players[pid]["room"] == players[id]["room"] and pid != id:
-                        # send them a message telling them that the player
-                        # entered the room
-                        mud.send_message(
-                            pid,
-                            "{} arrived via exit '{}'".format(players[id]["name"], ex),
-                        )
-
-                # send the player a message telling them where they are now
-                mud.send_message(id, "You arrive at '{}'".format(players[id]["room"]))
+                # send the new player a welcome message
+                mud.send_message(id, WELCOME_FMT.format(players[id]["name"]))
                 look(id)
-            # the specified exit wasn't found in the current room
+                # send the new player the description of their current room
+                mud.send_message(id, rooms[players[id]["room"]]["description"])
+
+            # each of the possible commands is handled by its function in the
+            # COMMANDS table. Try adding new commands to the game!
             else:
-                # send back an 'unknown exit' message
-                mud.send_message(id, "Unknown exit '{}'".format(ex))
-        elif command == "remember":
+                handler = COMMANDS.get(command)
+                if handler:
+                    handler(id, params)
+                # some other, unrecognised command
+                else:
+                    # send back an 'unknown command' message
+                    mud.send_message(id, UNKNOWN_COMMAND_FMT.format(command))
 
-            mud.send_message(id, "\nYou remember the following places:\n* "+"\n* ".join(players[id]["remember"])+"\n")
+        # send everything queued for the players during this tick
+        mud.flush()
 
-        elif command == "review":
-            rooms[players[id]["room"]]["description"] = params
-            # go through all the players in the game
-            mud.send_message(
-                id, "You remodel the '{}' room.".format(players[id]["room"])
-            )
-            for pid, pl in players.items():
-                # if player is in the same (new) room and isn't the player
-                # sending the command
-                if players[pid]["room"] == players[id]["room"] and pid != id:
-                    # send them a message telling them that the player
-                    # entered the room
-                    mud.send_message(
-                        pid, "{} remodeled the room.".format(players[id]["name"])
-                    )
-
-        # some other, unrecognised command
-        else:
-            # send back an 'unknown command' message
-            mud.send_message(id, "Unknown command '{}'".format(command))
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -26,15 +26,30 @@ SET_CHARGE_PUMP = const(0x8D)
 # Subclassing FrameBuffer provides support for graphics primitives
 # http://docs.micropython.org/en/latest/pyboard/library/framebuf.html
 class SSD1306(framebuf.FrameBuffer):
+    """SSD1306 display drawn through the FrameBuffer primitives.
+
+    show() only sends the pages drawn to since the previous show(). Every
+    FrameBuffer drawing method is overridden here to mark the rows it
+    touches. Anything drawn some other way, such as a FrameBuffer method
+    with no override or a direct write to 'buffer', must be followed by
+    touch() or touch_all(), or it never reaches the panel.
+    """
+
     def __init__(self, width, height, external_vcc):
         self.width = width
         self.height = height
         self.external_vcc = external_vcc
         self.pages = self.height // 8
-        self.buffer = bytearray(self.pages * self.width)
+        self.buffer = self.new_buffer(self.pages * self.width)
+        self.bufmv = memoryview(self.buffer)
+        # bitmask of pages drawn to since the last show(); only those are sent
+        self.dirty = 0
         super().__init__(self.buffer, self.width, self.height, framebuf.MONO_VLSB)
         self.init_display()
 
+    def new_buffer(self, size):
+        return bytearray(size)
+
     def init_display(self):
         for cmd in (
             SET_DISP | 0x00,  # off
@@ -85,6 +100,71 @@ class SSD1306(framebuf.FrameBuffer):
     def invert(self, invert):
         self.write_cmd(SET_NORM_INV | (invert & 1))
 
+    def touch(self, y0, y1):
+        # mark the pages covering rows y0..y1 as needing a flush
+        if y0 > y1:
+            y0, y1 = y1, y0
+        if y1 < 0 or y0 >= self.height:
+            return
+        p0 = max(y0, 0) >> 3
+        p1 = min(y1, self.height - 1) >> 3
+        self.dirty |= ((1 << (p1 + 1)) - 1) & ~((1 << p0) - 1)
+
+    def touch_all(self):
+        self.dirty = (1 << self.pages) - 1
+
+    def fill(self, c):
+        super().fill(c)
+        self.touch_all()
+
+    def pixel(self, x, y, c=None):
+        if c is None:
+            return super().pixel(x, y)
+        super().pixel(x, y, c)
+        self.touch(y, y)
+
+    def hline(self, x, y, w, c):
+        super().hline(x, y, w, c)
+        self.touch(y, y)
+
+    def vline(self, x, y, h, c):
+        super().vline(x, y, h, c)
+        self.touch(y, y + h - 1)
+
+    def line(self, x1, y1, x2, y2, c):
+        super().line(x1, y1, x2, y2, c)
+        self.touch(y1, y2)
+
+    def rect(self, x, y, w, h, c, *args):
+        super().rect(x, y, w, h, c, *args)
+        self.touch(y, y + h - 1)
+
+    def fill_rect(self, x, y, w, h, c):
+        super().fill_rect(x, y, w, h, c)
+        self.touch(y, y + h - 1)
+
+    def ellipse(self, x, y, xr, yr, c, *args):
+        super().ellipse(x, y, xr, yr, c, *args)
+        self.touch(y - yr, y + yr)
+
+    def poly(self, x, y, coords, c, *args):
+        super().poly(x, y, coords, c, *args)
+        ys = [coords[i] for i in range(1, len(coords), 2)]
+        if ys:
+            self.touch(y + min(ys), y + max(ys))
+
+    def text(self, s, x, y, c=1):
+        super().text(s, x, y, c)
+        self.touch(y, y + 7)
+
+    def scroll(self, xstep, ystep):
+        super().scroll(xstep, ystep)
+        self.touch_all()
+
+    def blit(self, *args):
+        super().blit(*args)
+        self.touch_all()
+
     def show(self):
         x0 = 0
         x1 = self.width - 1
@@ -92,13 +172,28 @@ class SSD1306(framebuf.FrameBuffer):
             # displays with width of 64 pixels are shifted by 32
             x0 += 32
             x1 += 32
-        self.write_cmd(SET_COL_ADDR)
-        self.write_cmd(x0)
-        self.write_cmd(x1)
-        self.write_cmd(SET_PAGE_ADDR)
-        self.write_cmd(0)
-        self.write_cmd(self.pages - 1)
-        self.write_data(self.buffer)
+        dirty = self.dirty
+        self.dirty = 0
+        # send each contiguous run of dirty pages as one windowed write
+        p = 0
+        while dirty:
+            if not dirty & 1:
+                dirty >>= 1
+                p += 1
+                continue
+            p0 = p
+            while dirty & 1:
+                dirty >>= 1
+                p += 1
+            self.write_window(x0, x1, p0, p - 1)
+            self.write_pages(p0, p - 1)
+
+    def write_pages(self, p0, p1):
+        self.write_data(self.bufmv[p0 * self.width:(p1 + 1) * self.width])
+
+    def write_window(self, x0, x1, p0, p1):
+        for cmd in (SET_COL_ADDR, x0, x1, SET_PAGE_ADDR, p0, p1):
+            self.write_cmd(cmd)
 
 
 class SSD1306_I2C(SSD1306):
@@ -106,6 +201,8 @@ class SSD1306_I2C(SSD1306):
         self.i2c = i2c
         self.addr = addr
         self.temp = bytearray(2)
+        self.window = bytearray(7)
+        self.window[0] = 0x00  # Co=0, D/C#=0: a stream of command bytes
         self.write_list = [b"\x40", None]  # Co=0, D/C#=1
         super().__init__(width, height, external_vcc)
 
@@ -114,6 +211,38 @@ class SSD1306_I2C(SSD1306):
         self.temp[1] = cmd
         self.i2c.writeto(self.addr, self.temp)
 
+    def write_window(self, x0, x1, p0, p1):
+        # send the whole column/page address setup in a single transaction
+        # instead of one transaction per command byte
+        w = self.window
+        w[1] = SET_COL_ADDR
+        w[2] = x0
+        w[3] = x1
+        w[4] = SET_PAGE_ADDR
+        w[5] = p0
+        w[6] = p1
+        self.i2c.writeto(self.addr, w)
+
+    def new_buffer(self, size):
+        # keep the 0x40 data control byte in front of the framebuffer, so a
+        # flush goes straight out of memory allocated once at init
+        self.txbuf = bytearray(size + 1)
+        self.txbuf[0] = 0x40  # Co=0, D/C#=1
+        self.txmv = memoryview(self.txbuf)
+        return self.txmv[1:]
+
+    def write_pages(self, p0, p1):
+        start = p0 * self.width
+        end = (p1 + 1) * self.width + 1
+        if end - start == len(self.txbuf):
+            self.i2c.writeto(self.addr, self.txbuf)
+            return
+        # borrow the byte in front of the first page for the control byte
+        saved = self.txbuf[start]
+        self.txbuf[start] = 0x40
+        self.i2c.writeto(self.addr, self.txmv[start:end])
+        self.txbuf[start] = saved
+
     def write_data(self, buf):
         self.write_list[1] = buf
         self.i2c.writevto(self.addr, self.write_list)
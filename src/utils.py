@@ -1,6 +1,12 @@
 import json
 import sys
 
+# whether we're running on the microcontroller rather than CPython. The ESP32
+# reports its platform as 'esp32', so match 'esp' anywhere in the name.
+# mudserver and simplemud use this flag rather than testing the platform
+# themselves
+ON_DEVICE = 'esp' in sys.platform or 'WiPy' in sys.platform
+
 if 'esp' in sys.platform:
     from urandom import getrandbits
 elif 'WiPy' in sys.platform:
@@ -8,6 +14,20 @@ elif 'WiPy' in sys.platform:
 else:
     from random import getrandbits
 
+# pick the password hash implementation once, at import
+if ON_DEVICE:
+    import uhashlib
+    import ubinascii
+
+    def password_hash(name, password):
+        return ubinascii.hexlify(uhashlib.sha1(password + 'weemud' + name).digest()).decode()
+else:
+    import hashlib
+
+    def password_hash(name, password):
+        return hashlib.sha1((password + 'weemud' + name).encode('utf-8')).hexdigest()
+
+
 codes = {'resetall': 0, 'bold': 1, 'underline': 4,
          'blink': 5, 'reverse': 7, 'boldoff': 22,
          'blinkoff': 25, 'underlineoff': 24, 'reverseoff': 27,
@@ -15,40 +35,13 @@ codes = {'resetall': 0, 'bold': 1, 'underline': 4,
          'yellow': 33, 'blue': 34, 'magenta': 35, 'cyan': 36,
          'white': 37 }
 
-
-def password_hash(name, password):
-    if sys.platform in ['esp', 'WiPy']:
-        import uhashlib
-        return ''.join(['%.2x' % i for i in uhashlib.sha1(password + 'weemud' + name).digest()])
-    else:
-        import hashlib
-        return ''.join(['%.2x' % i for i in hashlib.sha1(bytearray(password + 'weemud' + name, 'utf-8')).digest()])
-
-
-def get_color_list():
-    res = {}
-    for c in codes:
-        res['%' + c] = c
-    return res
-
-
-def get_color(name):
-    if name not in codes:
-        return ''
-    return '\x1b[{}m'.format(codes.get(name, 0))
+# the escape sequence for each color code, formatted once at import
+CODES = dict([(name, '\x1b[{}m'.format(v)) for name, v in codes.items()])
 
 
-def multiple_replace(text, replace_words, color_enabled=True):
-    for word, replacement in replace_words.items():
-        if color_enabled:
-            text = text.replace(word, get_color(replacement))
-        else:
-            text = text.replace(word, '')
-    return text
-
 def save_object_to_file(obj, filename):
     with open(filename.lower(), 'w', encoding='utf-8') as f:
-        f.write(json.dumps(obj))
+        json.dump(obj, f)
 
 
 def load_object_from_file(filename):
@@ -68,11 +61,12 @@ def randrange(start, stop=None):
         stop = start
         start = 0
     upper = stop - start
-    bits = 0
-    pwr2 = 1
-    while upper > pwr2:
-        pwr2 <<= 1
-        bits += 1
+    # the number of bits needed for values up to upper - 1. MicroPython ints
+    # have no bit_length(), but bin() does the work in C all the same
+    bits = len(bin(upper - 1)) - 2
+    # when upper is a power of two every draw is in range
+    if upper == 1 << bits:
+        return getrandbits(bits) + start
     while True:
         r = getrandbits(bits)
         if r < upper:
@@ -84,27 +78,45 @@ def get_att(d):
     att = 0
     if 'd' in d:
         dice = d.split('d')
-        for d in range(int(dice[0])):
-            att += randrange(int(dice[1])) + 1
+        n = int(dice[0])
+        sides = int(dice[1])
+        if sides & (sides - 1) == 0:
+            # a die with a power-of-two number of sides is just 'bits' random
+            # bits, so take several rolls from each draw without rejection.
+            # MicroPython hands out at most 32 bits per getrandbits call
+            bits = len(bin(sides)) - 3
+            att = n
+            while bits and n > 0:
+                k = min(n, 32 // bits)
+                r = getrandbits(k * bits)
+                for _ in range(k):
+                    att += r & (sides - 1)
+                    r >>= bits
+                n -= k
+        else:
+            for d in range(n):
+                att += randrange(sides) + 1
     else:
         att = int(d)
     return att
 
 
 def calc_att(mud, pid, attacks, bank, attack=None):
-    v_att = []
     att = 0
     if attack:
         colors = ['bold', 'yellow']
-        v_att.append(attack)
     else:
         colors = ['bold', 'magenta']
-        for attack in attacks:
-            if attack['cost'] < bank:
-                v_att.append(attack)
-    # Select a random attack
-    if len(v_att) > 0:
-        attack = v_att[randrange(len(v_att))]
+        # Select a random attack among the affordable ones, in one pass and
+        # without building a list of them: the n-th candidate replaces the
+        # current pick with probability 1/n
+        count = 0
+        for candidate in attacks:
+            if candidate['cost'] < bank:
+                count += 1
+                if randrange(count) == 0:
+                    attack = candidate
+    if attack:
         att = get_att(attack['dmg'])
         mud.send_message(pid, "%s for %d" % (attack['desc'], att,), color=colors)
 